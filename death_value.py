@@ -1,158 +1,186 @@
 import os 
 import sys 
+import math
 import argparse
 import numpy as np 
 import pandas as pd 
+import xlsxwriter
 import matplotlib.pyplot as plt
 
+from numba import njit, prange
 from colorama import Fore 
-from typing import Union, Dict, List, Tuple
+from xlsxwriter.utility import xl_rowcol_to_cell
 
 from awpy import Demo 
 from awpy.stats import calculate_trades
 from awpy.parsers.events import parse_kills 
 from awpy.plot import plot, PLOT_SETTINGS
 
-def calc_distance(x1, y1, x2, y2) -> float:
-    return np.sqrt((x1 - x2)**2 + (y1 - y2)**2)
-
-def softmax(distances: Union[List[float], np.ndarray]) -> np.ndarray:
-    distances = np.array(distances)
-    scaled_distances = distances / 1000
-    exp_distances = np.exp(-scaled_distances)
-    return exp_distances / np.sum(exp_distances)
-
-def get_teammates_on_death(
-        demo_data, player_name, player_deaths, kills
-) -> List[Tuple[int, int, str, float]]:
+@njit(cache=True)
+def closest_softmax(px, py, xs, ys) -> tuple:
     """
-    Gets the softmax value for each teammate of the given player at the
-    time of the player's death. The softmax is calculated from the euclidean
-    distance of the teammate from the player. 
+    Index of the point (xs[i], ys[i]) closest to (px, py) and its softmax value
+    over the negative scaled euclidean distances. Softmax is monotonic in the
+    distance, so the closest point has the highest value and only that one is
+    normalized: exp(0) / sum(exp(-(d - d_min) / 1000)).
 
-    Returns:
-        - The tick number.
-        - The round number.
-        - Name of the teammate.
-        - The softmax value of teammate at the player's death.
+    Returns (-1, nan) when there are no points.
     """
-    locations = list(
-        demo_data.ticks[["tick", "X", "Y", "team_name", "name"]]
-        .itertuples(index=False, name=None)
-    )
+    n = xs.size
+    if n == 0:
+        return -1, np.nan
 
-    teammates_data = []
-    for _, death in player_deaths.iterrows():
-        for _, kill in kills.iterrows():
-            if kill["tick"] == death["tick"]:
-                death_tick   = death["tick"]
-                round_num    = kill["round"]
-                player_x     = death["victim_X"]
-                player_y     = death["victim_Y"]
-                player_team  = death["victim_team_name"]
-
-                teammates = []
-                for tick, x, y, team_name, name in locations:
-                    if tick == death_tick and team_name == player_team:
-                        if name == player_name:
-                            continue 
-                        teammates.append((name, x, y))
-                
-                distances = []
-                for name, x, y in teammates:
-                    distance = calc_distance(player_x, player_y, x, y)
-                    distances.append(distance)
-                
-                softmax_values = softmax(distances)
-
-                for i, (name, distance) in enumerate(zip([tm[0] for tm in teammates], distances)):
-                    teammates_data.append((death_tick, round_num, name, softmax_values[i]))
-
-    return teammates_data
+    d = np.empty(n)
+    closest = 0
+    for i in range(n):
+        d[i] = math.hypot(px - xs[i], py - ys[i])
+        if d[i] < d[closest]:
+            closest = i
 
-def get_death_values(
-        teammates_data, player_name, kills
-) -> Dict[int, Tuple[float, bool, int, str]]:
+    s = 0.0
+    for i in range(n):
+        s += math.exp(-(d[i] - d[closest]) / 1000.0)
+
+    return closest, 1.0 / s
+
+@njit(parallel=True, cache=True)
+def group_closest_softmax(px, py, xs, ys, offsets) -> tuple:
     """
-    Calculates the maximum softmax value for each tick and determines if the death was traded.
-    
-    Returns:
-        A dictionary where the keys are tick numbers and the values are tuples containing:
-            - The highest softmax value for that tick.
-            - A boolean indicating if the death was traded.
-            - The round number.
-            - The teammate associated with the softmax (closest teammate).
+    Runs closest_softmax for each group of points, where group i spans
+    xs[offsets[i]:offsets[i + 1]] and is measured from (px[i], py[i]).
+    Groups are independent, so they are spread across threads.
+
+    Returns the index into xs of each group's closest point (-1 for empty
+    groups) and its softmax value.
     """
-    death_values = {}
-    trades = calculate_trades(kills)
+    n_groups = offsets.size - 1
+    closest = np.empty(n_groups, dtype=np.int64)
+    values = np.empty(n_groups)
+    for i in prange(n_groups):
+        start, end = offsets[i], offsets[i + 1]
+        idx, values[i] = closest_softmax(px[i], py[i], xs[start:end], ys[start:end])
+        closest[i] = start + idx if idx >= 0 else -1
 
-    for death in teammates_data:
-        tick          = death[0]
-        round_num     = death[1]
-        teammate      = death[2]
-        softmax_value = death[3]
-
-        if tick in death_values:
-            if softmax_value > death_values[tick][0]:
-                death_values[tick] = (softmax_value, False, round_num, teammate)
-        else:
-            death_values[tick] = (softmax_value, False, round_num, teammate)
-        
-    for _, trade in trades.iterrows():
-        trade_tick  = trade["tick"]
-        victim_name = trade["victim_name"]
-        was_traded  = trade["was_traded"]
+    return closest, values
 
-        if victim_name == player_name and was_traded:
-            if trade_tick in death_values:
-                current_softmax_value, _, existing_round, existing_teammate = death_values[trade_tick]
-                death_values[trade_tick] = (current_softmax_value, True, existing_round, existing_teammate)
+def ticks_at(ticks: pd.DataFrame, tick_numbers: np.ndarray) -> pd.DataFrame:
+    """
+    Gets the rows of the ticks dataframe at the given tick numbers. Ticks are
+    parsed in order, so each tick's rows are sliced out with a binary search
+    instead of being gathered by a membership test on every row. Checking the
+    order is still one vectorized pass over the tick column. If the frame is
+    not sorted, it falls back to an np.isin mask.
+    """
+    tick_numbers = np.unique(tick_numbers)
+    tick_arr = ticks["tick"].to_numpy()
+    if not ticks["tick"].is_monotonic_increasing:
+        return ticks[np.isin(tick_arr, tick_numbers)]
 
-    return death_values 
+    starts = np.searchsorted(tick_arr, tick_numbers, side="left")
+    ends = np.searchsorted(tick_arr, tick_numbers, side="right")
+    rows = [np.arange(start, end) for start, end in zip(starts, ends)]
+    return ticks.iloc[np.concatenate(rows)] if rows else ticks.iloc[:0]
 
-def calc_weight(death_values, alpha=0.7, beta=0.3) -> pd.DataFrame:
+def get_death_values(
+        ticks, player_name, player_deaths, kills, alpha=0.7, beta=0.3
+) -> pd.DataFrame:
     """
-    Experimientation with getting a weight value based of the softmax
-    (proximity of closest teammate teammate) and whether or not the death was traded.
+    Gets the closest teammate of the given player at the time of each of the
+    player's deaths and determines if the death was traded. The proximity is
+    the softmax of the euclidean distance of the teammates from the player.
+    The weighted score is alpha * (1 - proximity), plus a bonus of beta if the
+    death was traded. Only the rows of `ticks` at the death ticks are used, so
+    it can be pre-filtered with ticks_at. Deaths with no teammates alive are
+    left out.
 
     Alpha: A coefficient to represent the importance of proximity.
     Beta: A coefficient to represent the importance of a trade occuring.
 
-    Bonus if the death was traded. 
+    Returns:
+        A dataframe with a row per death and the columns:
+            - Tick: The tick number.
+            - Proximity: The softmax value of the closest teammate.
+            - Was Traded: A boolean indicating if the death was traded.
+            - Weighted Score: The weighted score of the death.
+            - Round: The round number.
+            - Closest Teammate: Name of the closest teammate.
     """
-    w_death_values = []
-    for tick, (softmax_value, was_traded, round_num, teammate) in death_values.items():
-        trade_bonus = beta if was_traded else 0 
-        weighted_score = alpha * (1 - softmax_value) + trade_bonus 
-        w_death_values.append((tick, softmax_value, was_traded, weighted_score, round_num, teammate))
-    
-    w_death_values = pd.DataFrame(w_death_values, columns=[
-        "Tick",
-        "Proximity",
-        "Was Traded",
-        "Weighted Score",
-        "Round",
-        "Closest Teammate"
-    ])
+    tick_to_round = kills.groupby("tick")["round"].first().to_dict()
+
+    deaths = player_deaths[player_deaths["tick"].isin(tick_to_round.keys())]
+    deaths = deaths.drop_duplicates("tick").sort_values("tick")
+    death_ticks = deaths["tick"].to_numpy()
+
+    # Teammate rows are kept as parallel arrays, each pointing back at its death.
+    locations = ticks_at(ticks, death_ticks)
+    death_idx = np.searchsorted(death_ticks, locations["tick"].to_numpy())
+    is_teammate = (
+        (locations["team_name"].to_numpy() == deaths["victim_team_name"].to_numpy()[death_idx])
+        & (locations["name"] != player_name).to_numpy()
+    )
+    order = np.argsort(death_idx[is_teammate], kind="stable")
+    death_idx = death_idx[is_teammate][order]
+    names = locations["name"].to_numpy()[is_teammate][order]
+    xs = locations["X"].to_numpy()[is_teammate][order]
+    ys = locations["Y"].to_numpy()[is_teammate][order]
+    offsets = np.searchsorted(death_idx, np.arange(death_ticks.size + 1))
+
+    closest, softmax_values = group_closest_softmax(
+        deaths["victim_X"].to_numpy(), deaths["victim_Y"].to_numpy(), xs, ys, offsets
+    )
+    has_teammate = closest >= 0
+    death_ticks = death_ticks[has_teammate]
+    softmax_values = softmax_values[has_teammate]
+
+    trades = calculate_trades(kills)
+    traded = (trades["victim_name"].to_numpy() == player_name) & trades["was_traded"].to_numpy(dtype=bool)
+    was_traded = np.isin(death_ticks, trades["tick"].to_numpy()[traded])
+
+    trade_bonus = np.where(was_traded, beta, 0.0)
+    weighted_score = alpha * (1 - softmax_values) + trade_bonus
+
+    w_death_values = pd.DataFrame({
+        "Tick": death_ticks,
+        "Proximity": softmax_values,
+        "Was Traded": was_traded,
+        "Weighted Score": weighted_score,
+        "Round": deaths["tick"].map(tick_to_round).to_numpy()[has_teammate],
+        "Closest Teammate": names[closest[has_teammate]]
+    })
 
     return w_death_values
 
 def export_dv_xlsx(w_death_values, player_name) -> None:
-    with pd.ExcelWriter(f"{player_name}_deaths.xlsx", engine="xlsxwriter") as writer:
-        w_death_values.to_excel(writer, index=False, sheet_name="Death Analysis")
-        workbook = writer.book 
-        worksheet = writer.sheets["Death Analysis"]
+    n_rows = len(w_death_values)
+    ws_stats = w_death_values["Weighted Score"].agg(["min", "mean", "max"])
+    px_stats = w_death_values["Proximity"].agg(["min", "max"])
+
+    # constant_memory streams each row to disk once the next one is started, so
+    # the rows are written in order here. DataFrame.to_excel writes column by
+    # column and would lose all but the last column.
+    with xlsxwriter.Workbook(f"{player_name}_deaths.xlsx", {"constant_memory": True}) as workbook:
+        worksheet = workbook.add_worksheet("Death Analysis")
+        header_format = workbook.add_format(
+            {"bold": True, "border": 1, "align": "center", "valign": "top"}
+        )
 
-        weighted_score_col = w_death_values.columns.get_loc("Weighted Score") + 1
-        weighted_score_range = f"{chr(64 + weighted_score_col)}2:{chr(64 + weighted_score_col)}{len(w_death_values) + 1}"
+        # Missing values are written as blank cells, as to_excel did.
+        cells = w_death_values.astype(object).where(w_death_values.notna(), None)
+
+        worksheet.write_row(0, 0, w_death_values.columns, header_format)
+        for row, values in enumerate(cells.itertuples(index=False, name=None), start=1):
+            worksheet.write_row(row, 0, values)
+
+        weighted_score_col = w_death_values.columns.get_loc("Weighted Score")
+        weighted_score_range = f"{xl_rowcol_to_cell(1, weighted_score_col)}:{xl_rowcol_to_cell(n_rows, weighted_score_col)}"
 
         worksheet.conditional_format(
             weighted_score_range,
             {
                 'type': '3_color_scale',
-                'min_value': w_death_values['Weighted Score'].min(), 
-                'mid_value': w_death_values['Weighted Score'].mean(),
-                'max_value': w_death_values['Weighted Score'].max(),
+                'min_value': ws_stats['min'], 
+                'mid_value': ws_stats['mean'],
+                'max_value': ws_stats['max'],
                 'min_type': 'min',
                 'mid_type': 'percentile',
                 'max_type': 'max',
@@ -162,15 +190,15 @@ def export_dv_xlsx(w_death_values, player_name) -> None:
             }
         )
 
-        softmax_col = w_death_values.columns.get_loc("Proximity") + 1
-        softmax_range = f'{chr(64 + softmax_col)}2:{chr(64 + softmax_col)}{len(w_death_values) + 1}'
+        softmax_col = w_death_values.columns.get_loc("Proximity")
+        softmax_range = f"{xl_rowcol_to_cell(1, softmax_col)}:{xl_rowcol_to_cell(n_rows, softmax_col)}"
 
         worksheet.conditional_format(
             softmax_range,
             {
                 'type': '2_color_scale',
-                'min_value': w_death_values['Proximity'].min(),
-                'max_value': w_death_values['Proximity'].max(),
+                'min_value': px_stats['min'],
+                'max_value': px_stats['max'],
                 'min_type': 'min',
                 'max_type': 'max',
                 'min_color': "#FFEB84",
@@ -184,31 +212,21 @@ def gen_death_map(player_deaths, w_death_values, map_name) -> None:
     TODO: Issue with large labels overlapping. Hard to see some tick numbers.
     TODO: Probably add teammates and seperate these out by round.
     """
-    points = []
-    point_settings = []
-    for _, death in player_deaths.iterrows():
-        row = w_death_values[w_death_values["Tick"] == death["tick"]]
-        points.append((death["victim_X"], death["victim_Y"], death["victim_Z"]))
-
-        score = row["Weighted Score"].values[0]
-        if score >= 0.6:
-            color = "green"
-        elif score >= 0.38:
-            color = "yellow"
-        else:
-            color = "red"
-
-        settings = PLOT_SETTINGS.copy()
-        settings.update(
-            {
-                "color": color,
-                "size": 3, 
-                "label": death["tick"],
-            }
-        )
+    deaths = player_deaths.merge(
+        w_death_values[["Tick", "Weighted Score"]],
+        left_on="tick",
+        right_on="Tick"
+    )
+    points = list(zip(deaths["victim_X"], deaths["victim_Y"], deaths["victim_Z"]))
+
+    scores = deaths["Weighted Score"]
+    colors = np.select([scores >= 0.6, scores >= 0.38], ["green", "yellow"], default="red")
+
+    point_settings = [
+        {**PLOT_SETTINGS, "color": color, "size": 3, "label": tick}
+        for color, tick in zip(colors.tolist(), deaths["tick"])
+    ]
 
-        point_settings.append(settings)
-    
     plot(map_name, points, point_settings)
     plt.savefig("deathmap.png", format='png')
 
@@ -234,19 +252,22 @@ if __name__ == '__main__':
         sys.exit()
     
     parsed_kills = parse_kills(demo_data.events)
+    parsed_kills = parsed_kills.astype(
+        {"victim_name": "category", "attacker_name": "category", "victim_team_name": "category"}
+    )
     player_deaths = parsed_kills[parsed_kills["victim_name"] == args.player_name]
 
+    ticks_subset = ticks_at(demo_data.ticks, player_deaths["tick"].to_numpy())
+    ticks_subset = ticks_subset.astype(
+        {"X": np.float32, "Y": np.float32, "team_name": "category", "name": "category"}
+    )
+
     kills = demo_data.kills
 
-    print(Fore.GREEN + "\n[>] Getting all teammates distances for each death event..\n")
+    print(Fore.GREEN + "\n[>] Getting the closest teammate, trade & weighted score for each death event..\n")
     print(Fore.MAGENTA + f"[>] Found {len(player_deaths)} death events for: " + Fore.CYAN + f"{args.player_name}\n")
-    teammates_data = get_teammates_on_death(demo_data, args.player_name, player_deaths, kills)
-
-    print(Fore.GREEN + "[>] Getting the closest teammates & checking if the death was traded..\n")
-    death_values = get_death_values(teammates_data, args.player_name, kills)
+    w_death_values = get_death_values(ticks_subset, args.player_name, player_deaths, kills)
 
-    print(Fore.GREEN + "[>] Weighing death values..\n")
-    w_death_values = calc_weight(death_values)
     print(Fore.CYAN + f"================= Deaths Data for {args.player_name} =================")
     print(Fore.WHITE + f"{w_death_values}\n")
 